@@ -1,23 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
+import hashlib
 import io
 import itertools as it
 import json
-import multiprocessing as mp
-import multiprocessing.dummy as mp_dummy
 import os
 import os.path as path
 import sys
-from time import strptime, strftime, mktime
-import urllib.request
+from time import strptime, strftime, mktime, sleep
 from glob import iglob, glob
 import threading
-import time
 import subprocess
 
 import appdirs
+import httpx
 import numpy as np
 from PIL import Image
 from dateutil.tz import tzlocal
@@ -28,9 +28,97 @@ from himawaripy.mapper import Mapper
 
 # Semantic Versioning: Major, Minor, Patch
 HIMAWARIPY_VERSION = (3, 0, 1)
-counter = None
+counter = 0
 HEIGHT = 550
 WIDTH = 550
+MAX_CONNECTIONS = 4
+DOWNLOAD_TIMEOUT = 10.0
+DOWNLOAD_ATTEMPTS = 3
+
+# Transport-level retries only cover connection failures; these transient
+# statuses have to be retried by hand or one flaky tile aborts the run.
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Payload length of the blank "No Image" tile. The old check compared
+# bytes.__sizeof__() against 2867, which is this length plus the 33 bytes of
+# CPython object overhead -- an implementation detail we should not rely on.
+BLANK_TILE_LEN = 2834
+
+# Conditional-GET state: {url: {"etag": ..., "last_modified": ...}} plus one
+# body file per URL, so the CDN can answer 304 for unchanged content.
+HTTP_CACHE_DIR = path.join(appdirs.user_cache_dir(appname="himawaripy", appauthor=False), "http-cache")
+http_cache = None
+http_cache_accessed = set()
+
+
+def get_http_cache():
+    global http_cache
+    if http_cache is None:
+        try:
+            with open(path.join(HTTP_CACHE_DIR, "index.json")) as f:
+                http_cache = json.load(f)
+        except (OSError, ValueError):
+            http_cache = {}
+    return http_cache
+
+
+def save_http_cache():
+    if http_cache is None:
+        return
+    # Tile URLs are unique per frame, so drop everything that was not
+    # requested during this run to keep the cache bounded.
+    for url in list(http_cache):
+        if url not in http_cache_accessed:
+            del http_cache[url]
+    os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+    with open(path.join(HTTP_CACHE_DIR, "index.json"), "w") as f:
+        json.dump(http_cache, f)
+    # Sweep the directory rather than the index: interrupted runs (deadline
+    # kill, blank-tile exit) write body files that never make it into a
+    # saved index, and those would otherwise accumulate forever.
+    retained = {path.basename(cached_body_path(url)) for url in http_cache}
+    retained.add("index.json")
+    for name in os.listdir(HTTP_CACHE_DIR):
+        if name not in retained:
+            try:
+                os.remove(path.join(HTTP_CACHE_DIR, name))
+            except OSError:
+                pass
+
+
+def cached_body_path(url):
+    return path.join(HTTP_CACHE_DIR, hashlib.sha1(url.encode()).hexdigest())
+
+
+def conditional_headers(url):
+    entry = get_http_cache().get(url)
+    headers = {}
+    if entry and path.isfile(cached_body_path(url)):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def handle_response(url, response):
+    http_cache_accessed.add(url)
+    if response.status_code == 304:
+        with open(cached_body_path(url), "rb") as f:
+            return f.read()
+
+    response.raise_for_status()
+    content = response.content
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if etag or last_modified:
+        os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+        with open(cached_body_path(url), "wb") as f:
+            f.write(content)
+        get_http_cache()[url] = {"etag": etag, "last_modified": last_modified}
+
+    return content
 
 
 def calculate_time_offset(latest_date, auto, preferred_offset):
@@ -53,32 +141,81 @@ def calculate_time_offset(latest_date, auto, preferred_offset):
     return offset_time
 
 
-def download_chunk(args):
-    global counter
-
-    img_type, x, y, latest, level, w, h = args
-    if img_type == "vis":
-        type_name = "D531106"
-    elif img_type == "ir":
-        type_name = "INFRARED_FULL"
+def decode_tile(canvas, row, col, tiledata):
+    # Each tile owns a disjoint region of the canvas, so the slice assignment
+    # needs no locking.
+    tile = np.asarray(Image.open(io.BytesIO(tiledata)).convert("RGB"))
+    canvas[
+        HEIGHT * row:HEIGHT * (row + 1),
+        WIDTH * col:WIDTH * (col + 1),
+        :
+    ] = tile
 
-    url_format = "https://himawari8.nict.go.jp/img/{}/{}d/{}/{}_{}_{}.png"
-    url = url_format.format(type_name, level, WIDTH, strftime("%Y/%m/%d/%H%M%S", latest), x, y)
 
+async def download_chunk(client, decoder, canvas, offset, url_prefix, latest, total, x, y):
+    global counter
 
-    tiledata = download(url)
-
-    # If the tile data is 2867 bytes, it is a blank "No Image" tile.
-    if tiledata.__sizeof__() == 2867:
+    x1, y1 = offset
+    url = "{}_{}_{}.png".format(url_prefix, x, y)
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        # Transport errors raised mid-request (read timeouts, HTTP/2
+        # GOAWAY/RST_STREAM) are as transient as the retryable statuses.
+        try:
+            response = await client.get(url, headers=conditional_headers(url))
+        except httpx.TransportError:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            response = None
+        if response is not None and (response.status_code not in RETRY_STATUSES
+                                     or attempt == DOWNLOAD_ATTEMPTS):
+            break
+        print("[{}/{}] Retrying to download '{}'...".format(attempt, DOWNLOAD_ATTEMPTS, url))
+        await asyncio.sleep(0.5 * attempt)
+    tiledata = handle_response(url, response)
+
+    # A payload of exactly BLANK_TILE_LEN bytes is the blank "No Image" tile.
+    if len(tiledata) == BLANK_TILE_LEN:
         sys.exit('No image available for {}.'.format(strftime("%Y/%m/%d %H:%M:%S", latest)))
 
-    with counter.get_lock():
-        counter.value += 1
-        if counter.value == level * level:
-            print("Downloading tiles: completed.")
-        else:
-            print("Downloading tiles: {}/{} completed...".format(counter.value, w * h))
-    return x, y, tiledata
+    # Decode and blit while the remaining downloads are still in flight.
+    await asyncio.get_running_loop().run_in_executor(
+        decoder, decode_tile, canvas, y - y1, x - x1, tiledata)
+
+    # All increments happen on the event-loop thread, so no lock is needed.
+    # Report in ~5% steps instead of once per tile to keep stdio off the
+    # hot path (400 prints at level 20 is pure overhead).
+    counter += 1
+    if counter == total:
+        print("Downloading tiles: completed.")
+    elif counter % max(1, total // 20) == 0:
+        print("Downloading tiles: {}/{} completed...".format(counter, total))
+
+
+async def download_row(client, decoder, canvas, offset, url_prefix, latest, total, y, xs):
+    # Each coroutine walks one row sequentially; rows run concurrently, so
+    # at most h tiles are in flight instead of all w * h at once.
+    for x in xs:
+        await download_chunk(client, decoder, canvas, offset, url_prefix, latest, total, x, y)
+
+
+async def download_tiles(tiles, url_prefix, latest, canvas, offset):
+    # HTTP/2 multiplexes all the tile requests over a handful of connections,
+    # so one TLS handshake serves tens of in-flight GETs.
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+        retries=3
+    )
+    rows = {}
+    for (x, y) in tiles:
+        rows.setdefault(y, []).append(x)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as decoder:
+        async with httpx.AsyncClient(transport=transport, timeout=DOWNLOAD_TIMEOUT) as client:
+            await asyncio.gather(*[
+                download_row(client, decoder, canvas, offset,
+                             url_prefix, latest, len(tiles), y, sorted(xs))
+                for y, xs in rows.items()
+            ])
 
 
 def parse_args():
@@ -153,35 +290,40 @@ def is_discharging():
 
 
 def download(url):
-    exception = None
-
-    for i in range(1, 4):  # retry max 3 times
-        try:
-            with urllib.request.urlopen(url) as response:
-                return response.read()
-        except Exception as e:
-            exception = e
-            print("[{}/3] Retrying to download '{}'...".format(i, url))
-            time.sleep(1)
-            pass
-
-    if exception:
-        raise exception
-    else:
-        sys.exit("Could not download '{}'!\n".format(url))
+    # One-shot fetch (latest.json); the transport retries connection
+    # failures, the loop retries transient statuses.
+    with httpx.Client(transport=httpx.HTTPTransport(retries=3), timeout=DOWNLOAD_TIMEOUT) as client:
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                response = client.get(url, headers=conditional_headers(url))
+            except httpx.TransportError:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                response = None
+            if response is not None and (response.status_code not in RETRY_STATUSES
+                                         or attempt == DOWNLOAD_ATTEMPTS):
+                break
+            print("[{}/{}] Retrying to download '{}'...".format(attempt, DOWNLOAD_ATTEMPTS, url))
+            sleep(0.5 * attempt)
+    return handle_response(url, response)
+
+
+# Color of the border lines in the original RGB border assets; the shipped
+# files are 1-bit masks now, so the color has to come from here.
+BORDER_COLOR = (255, 255, 0)
 
 
 def overlay_borders(img, bd):
-    img = np.array(img)
-    bd = np.array(bd)[:, :, :3]
-    mask_img = (bd == [255, 255, 255]).all(axis=2)
-    mask_img = np.tile(mask_img, [3, 1, 1]).transpose([1, 2, 0])
-    return Image.fromarray(img * mask_img + bd * ~mask_img, "RGB")
+    # bd is a 1-bit mask image: 1 means keep the image pixel, 0 is a border
+    # line. Painting the lines in place avoids allocating a full-size output.
+    mask = np.asarray(bd, dtype=bool)
+    img[~mask] = BORDER_COLOR
+    return img
 
 
 def thread_main(args):
     global counter
-    counter = mp.Value("i", 0)
+    counter = 0
 
     level = args.level  # since we are going to use it a lot of times
     x1, y1, x2, y2 = args.tiles
@@ -194,6 +336,27 @@ def thread_main(args):
     latest = strptime(json.loads(latest_json.decode("utf-8"))["date"], "%Y-%m-%d %H:%M:%S")
 
     print("Latest version: {} GMT.".format(strftime("%Y/%m/%d %H:%M:%S", latest)))
+
+    # Most cron invocations run before the satellite publishes a new frame.
+    # If the latest date and our settings match the previous run and its
+    # output is still around, skip the whole download/stitch/save cycle.
+    last_run_file = path.join(appdirs.user_cache_dir(appname="himawaripy", appauthor=False), "last_run.json")
+    run_config = repr(sorted(vars(args).items()))
+    try:
+        with open(last_run_file) as f:
+            last_run = json.load(f)
+    except (OSError, ValueError):
+        last_run = {}
+    if (last_run.get("date") == strftime("%Y-%m-%d %H:%M:%S", latest)
+            and last_run.get("config") == run_config
+            and path.isfile(last_run.get("output", ""))):
+        print("Already processed the latest image, reusing '{}'...".format(last_run["output"]))
+        if not args.dont_change:
+            r = set_background(last_run["output"])
+            if not r:
+                sys.exit("Your desktop environment '{}' is not supported!\n".format(get_desktop_environment()))
+        return
+
     requested_time = calculate_time_offset(latest, args.auto_offset, args.offset)
     if args.auto_offset or args.offset != 10:
         print("Offset version: {} GMT.".format(strftime("%Y/%m/%d %H:%M:%S", requested_time)))
@@ -208,31 +371,24 @@ def thread_main(args):
             center=args.center
         )
 
-    png = Image.new("RGB", (WIDTH * w, HEIGHT * h))
+    # np.empty skips the zero-fill; every pixel is overwritten by a tile below.
+    canvas = np.empty((HEIGHT * h, WIDTH * w, 3), dtype=np.uint8)
 
-    p = mp_dummy.Pool(w * h)
     print("Downloading tiles...")
-    res = p.map(download_chunk, it.product(
-        (args.img_type,),
-        range(x1, x2 + 1),
-        range(y1, y2 + 1),
-        (requested_time,),
-        (args.level,),
-        (w,),
-        (h,),
-    ))
-
     # TODO infrared images have two channels, need to convert them into more visually clear images.
-    for (x, y, tiledata) in res:
-        tile = Image.open(io.BytesIO(tiledata))
-        png.paste(tile, (
-            WIDTH * (x - x1),
-            HEIGHT * (y - y1),
-            WIDTH * (x - x1 + 1),
-            HEIGHT * (y - y1 + 1)
-        ))
-
-    for file in iglob(path.join(args.output_dir, "himawari-*.png")):
+    # Everything but the tile indices is identical across tiles, so build the
+    # URL prefix (type, level, timestamp) once instead of per tile.
+    type_name = "D531106" if args.img_type == "vis" else "INFRARED_FULL"
+    url_prefix = "https://himawari8.nict.go.jp/img/{}/{}d/{}/{}".format(
+        type_name, level, WIDTH, strftime("%Y/%m/%d/%H%M%S", requested_time))
+    tiles = [(x, y) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)]
+    asyncio.run(download_tiles(tiles, url_prefix, requested_time, canvas, (x1, y1)))
+
+    # The .png pattern still matters for files left over from older versions,
+    # and .bmp.tmp catches a temp file orphaned by an interrupted save.
+    for file in it.chain(iglob(path.join(args.output_dir, "himawari-*.bmp")),
+                         iglob(path.join(args.output_dir, "himawari-*.bmp.tmp")),
+                         iglob(path.join(args.output_dir, "himawari-*.png"))):
         os.remove(file)
 
     # Overlay border
@@ -243,7 +399,7 @@ def thread_main(args):
             "border{}.png".format(args.level)
         ))
         border = border.crop((WIDTH * x1, HEIGHT * y1, WIDTH * (x2 + 1), HEIGHT * (y2 + 1)))
-        png = overlay_borders(png, border)
+        canvas = overlay_borders(canvas, border)
 
     # Get width and height of the crop (optional)
     width = args.screen_width
@@ -263,11 +419,13 @@ def thread_main(args):
             # Crop the top and the bottom
             height = WIDTH * w / args.screen_ratio
 
-    # Map or crop
+    # Map or crop; the canvas stays an ndarray until this point so neither
+    # branch pays for a PIL round-trip copy of the full image.
     if mapper is not None and width != 0 and height != 0:
         # Project to the map plane
-        png = mapper.transform(png, width, height) 
+        png = mapper.transform(canvas, width, height)
     else:
+        png = Image.fromarray(canvas, "RGB")
         # Center crop if screen ratio is provided
         if height != 0:
             l = 0
@@ -283,10 +441,25 @@ def thread_main(args):
             b = HEIGHT * h
             png = png.crop((l, t, r, b))
 
-    output_file = path.join(args.output_dir, strftime("himawari-%Y%m%dT%H%M%S.png", requested_time))
+    output_file = path.join(args.output_dir, strftime("himawari-%Y%m%dT%H%M%S.bmp", requested_time))
     print("Saving to '%s'..." % (output_file,))
     os.makedirs(path.dirname(output_file), exist_ok=True)
-    png.save(output_file, "PNG")
+    # The file is consumed by the desktop environment and replaced on the
+    # next run, so skip compression entirely: BMP is a header plus raw RGB.
+    # Write to a temp path in the same directory and rename atomically, so
+    # the desktop environment can never pick up a half-written file.
+    tmp_file = output_file + ".tmp"
+    png.save(tmp_file, "BMP")
+    os.replace(tmp_file, output_file)
+
+    os.makedirs(path.dirname(last_run_file), exist_ok=True)
+    with open(last_run_file, "w") as f:
+        json.dump({
+            "date": strftime("%Y-%m-%d %H:%M:%S", latest),
+            "output": output_file,
+            "config": run_config
+        }, f)
+    save_http_cache()
 
     if not args.dont_change:
         r = set_background(output_file)
@@ -1,9 +1,64 @@
+import hashlib
 import math
+import os
 
+import appdirs
 from PIL import Image
 import cv2
 import numpy as np
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+
+def _compute_map_xy(width, height, scale, ctr_lat, ctr_long, sat_lat, sat_long,
+                    earth_rad_im, imsize, xoff_px, yoff_px):
+    # Fused map_to_cartesian + cartesian_to_earth: one parallel pass over the
+    # grid instead of a dozen full-size ndarray temporaries. Kept in plain
+    # Python semantics so numba can compile it when available.
+    theta_prime = math.pi * 0.5 - sat_lat
+    phi_prime = sat_long - ctr_long
+
+    sin_th_p = math.sin(theta_prime)
+    cos_th_p = math.cos(theta_prime)
+    sin_ph_p = math.sin(phi_prime)
+    cos_ph_p = math.cos(phi_prime)
+
+    ctr_offset = 2.0 * (1.0 - math.sin(ctr_lat))
+
+    # One interleaved (height, width, 2) map: cv2.remap accepts CV_32FC2
+    # directly and scans a single contiguous buffer instead of two.
+    xy_map = np.empty((height, width, 2), dtype=np.float32)
+
+    for i in prange(height):
+        x_map = (i - height * 0.5) * scale + ctr_offset
+        for j in range(width):
+            y_map = (j - width * 0.5) * scale
+
+            # Inverse Lambert azimuthal equal-area projection
+            sum_of_sq = x_map * x_map + y_map * y_map
+            factor = math.sqrt(1.0 - sum_of_sq * 0.25)
+            x_std = x_map * factor
+            y_std = y_map * factor
+            z_std = 1.0 - sum_of_sq * 0.5
+
+            # Rotate into the satellite (prime) frame; the x component is
+            # never used for the image coordinates.
+            y_prime = -sin_ph_p * x_std + cos_ph_p * y_std
+            z_prime = -cos_th_p * cos_ph_p * x_std - cos_th_p * sin_ph_p * y_std + sin_th_p * z_std
+
+            xy_map[i, j, 0] = ( y_prime * earth_rad_im + 1.0) * imsize * 0.5 - xoff_px
+            xy_map[i, j, 1] = (-z_prime * earth_rad_im + 1.0) * imsize * 0.5 - yoff_px
+
+    return xy_map
+
+
+if njit is not None:
+    _compute_map_xy = njit(parallel=True, fastmath=True, cache=True)(_compute_map_xy)
+
 
 class Mapper(object):
     def __init__(self, level=20, offset=(5, 2), scale=1.0, center=""):
@@ -43,7 +98,25 @@ class Mapper(object):
         self.him_width = 550
         self.him_height = 550
 
-    def earth_to_cartesian(self, earth_coord, longitude=0.0):
+        # The rotation between the satellite (prime) frame and the standard
+        # frame only depends on the satellite position and the map center,
+        # all fixed for the lifetime of a Mapper, so build it once here.
+        theta_prime = math.pi * 0.5 - self.sat_lat
+        phi_prime = self.sat_long - self.ctr_long
+
+        sin_th_p = math.sin(theta_prime)
+        cos_th_p = math.cos(theta_prime)
+        sin_ph_p = math.sin(phi_prime)
+        cos_ph_p = math.cos(phi_prime)
+
+        self._prime_to_std = np.array([
+            [sin_th_p * cos_ph_p, -sin_ph_p, -cos_th_p * cos_ph_p],
+            [sin_th_p * sin_ph_p,  cos_ph_p, -cos_th_p * sin_ph_p],
+            [           cos_th_p,         0,             sin_th_p]
+        ], dtype=np.float32)
+        self._std_to_prime = self._prime_to_std.T
+
+    def earth_to_cartesian(self, earth_coord):
         # self.him_width == self.him_height
         imsize = self.him_width * self.level
         xoff, yoff = self.offset
@@ -57,44 +130,17 @@ class Mapper(object):
         # Coordinates are normalized by the Earth radius
         y_prime = ( 2.0 * x_earth / float(imsize) - 1.0) / self.earth_rad_im
         z_prime = (-2.0 * y_earth / float(imsize) + 1.0) / self.earth_rad_im
-        x_prime = math.sqrt(1.0 - y_prime * y_prime - z_prime * z_prime)
+        x_prime = np.sqrt(1.0 - y_prime * y_prime - z_prime * z_prime)
 
         # Convert to the standard Cartesian coordinate
         prime_coord = np.array([x_prime, y_prime, z_prime])
 
-        theta_prime = math.pi * 0.5 - self.sat_lat
-        phi_prime = self.sat_long - longitude
-
-        sin_th_p = math.sin(theta_prime)
-        cos_th_p = math.cos(theta_prime)
-        sin_ph_p = math.sin(phi_prime)
-        cos_ph_p = math.cos(phi_prime)
-
-        prime_to_std = np.array([
-            [sin_th_p * cos_ph_p, -sin_ph_p, -cos_th_p * cos_ph_p],
-            [sin_th_p * sin_ph_p,  cos_ph_p, -cos_th_p * sin_ph_p],
-            [           cos_th_p,         0,             sin_th_p]
-        ])
-
-        return prime_to_std.dot(prime_coord.reshape(3, -1)) \
-                .reshape(prime_coord.shape)
-
-    def cartesian_to_earth(self, std_coord, longitude=0.0):
-        theta_prime = math.pi * 0.5 - self.sat_lat
-        phi_prime = self.sat_long - longitude
-
-        sin_th_p = math.sin(theta_prime)
-        cos_th_p = math.cos(theta_prime)
-        sin_ph_p = math.sin(phi_prime)
-        cos_ph_p = math.cos(phi_prime)
+        # einsum contracts over the coordinate axis without the
+        # reshape(3, -1) / reshape-back round trip of a plain dot.
+        return np.einsum("ij,j...->i...", self._prime_to_std, prime_coord)
 
-        std_to_prime = np.array([
-            [ sin_th_p * cos_ph_p,  sin_th_p * sin_ph_p, cos_th_p],
-            [           -sin_ph_p,             cos_ph_p,        0],
-            [-cos_th_p * cos_ph_p, -cos_th_p * sin_ph_p, sin_th_p]
-        ])
-        prime_coord = std_to_prime.dot(std_coord.reshape(3, -1)) \
-                .reshape(std_coord.shape)
+    def cartesian_to_earth(self, std_coord):
+        prime_coord = np.einsum("ij,j...->i...", self._std_to_prime, std_coord)
 
         x_prime = prime_coord[0, :]
         y_prime = prime_coord[1, :]
@@ -119,8 +165,8 @@ class Mapper(object):
 
         # Lambert azimuthal equal-area projection
         temp = np.sqrt(2.0 / (1.0 + z_std))
-        x_map = temp.multiply(x_std)
-        y_map = temp.multiply(y_std)
+        x_map = temp * x_std
+        y_map = temp * y_std
         
         # Correct the map coordinate with the map center
         # TODO
@@ -134,40 +180,91 @@ class Mapper(object):
         #  earth_rad_px = 0.5 * self.level * self.him_width * self.earth_rad_im # pixels
         scale = self.km_per_pixel / self.earth_rad_km
         scale /= (2.0 * math.cos(self.ctr_lat))
-        y_lin = (np.arange(width) - width * 0.5) * scale
-        x_lin = (np.arange(height) - height * 0.5) * scale
+        # cv2.remap only reads float32 maps, so there is no point carrying
+        # the grid through the pipeline in float64.
+        y_lin = (np.arange(width, dtype=np.float32) - width * 0.5) * scale
+        x_lin = (np.arange(height, dtype=np.float32) - height * 0.5) * scale
 
         # The map ractangle is placed with x-offset.
         ctr_offset = 2.0 * (1.0 - math.sin(self.ctr_lat))
         x_lin += ctr_offset
         y_map, x_map = np.meshgrid(y_lin, x_lin)
 
-        sum_of_sq = np.multiply(x_map, x_map) + np.multiply(y_map, y_map)
-        factor = np.sqrt(1.0 - sum_of_sq * 0.25)
+        # The grid is memory-bound, so compute in place where possible
+        # instead of materializing a fresh temporary per operation.
+        sum_of_sq = np.square(x_map)
+        sum_of_sq += np.square(y_map)
+
+        factor = np.multiply(sum_of_sq, -0.25)
+        factor += 1.0
+        np.sqrt(factor, out=factor)
 
         # Inverse Lambert azimuthal equal-area projection
-        x_std = np.multiply(x_map, factor)
-        y_std = np.multiply(y_map, factor)
-        z_std = 1.0 - sum_of_sq * 0.5
+        x_std = np.multiply(x_map, factor, out=x_map)
+        y_std = np.multiply(y_map, factor, out=y_map)
+        z_std = np.multiply(sum_of_sq, -0.5, out=sum_of_sq)
+        z_std += 1.0
 
         return np.stack([x_std, y_std, z_std], axis=0)
 
     def get_map_transforms(self, width, height):
-        std_coord = self.map_to_cartesian(width, height)
-        earth_coord = self.cartesian_to_earth(std_coord, longitude=self.ctr_long)
+        # The grid only depends on the projection parameters and the output
+        # geometry, which are fixed across cron invocations, so memoize it
+        # on disk and skip the whole trig pipeline on subsequent runs.
+        key = hashlib.sha1(repr((
+            self.level, self.offset, self.km_per_pixel,
+            self.ctr_lat, self.ctr_long, width, height
+        )).encode()).hexdigest()
+        cache_path = os.path.join(
+            appdirs.user_cache_dir(appname="himawaripy", appauthor=False),
+            "maps",
+            "map-{}.npz".format(key)
+        )
+        # A missing file is the common miss, but a truncated or corrupt one
+        # (deadline kill, power loss) raises BadZipFile/ValueError instead of
+        # OSError -- treat anything unreadable as a miss and recompute.
+        try:
+            cached = np.load(cache_path)
+            return cached["xy"]
+        except Exception:
+            pass
+
+        if njit is not None:
+            scale = self.km_per_pixel / self.earth_rad_km
+            scale /= (2.0 * math.cos(self.ctr_lat))
+            xy_map = _compute_map_xy(
+                width, height, scale,
+                self.ctr_lat, self.ctr_long, self.sat_lat, self.sat_long,
+                self.earth_rad_im, self.him_width * self.level,
+                self.offset[0] * self.him_width, self.offset[1] * self.him_height
+            )
+        else:
+            std_coord = self.map_to_cartesian(width, height)
+            earth_coord = self.cartesian_to_earth(std_coord)
 
-        x_earth = earth_coord[0, :].astype(np.float32)
-        y_earth = earth_coord[1, :].astype(np.float32)
+            # Interleave into one (height, width, 2) CV_32FC2 buffer so remap
+            # scans a single contiguous map instead of two separate ones.
+            xy_map = np.stack([earth_coord[0, :], earth_coord[1, :]], axis=-1) \
+                    .astype(np.float32, copy=False)
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Write through a temp file and rename so an interrupted run can
+        # never leave a half-written cache at the final path.
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, xy=xy_map)
+        os.replace(tmp_path, cache_path)
+
+        return xy_map
 
-        return x_earth, y_earth
-    
     def transform(self, src, width, height):
-        src = np.array(src)
-        map_to_x, map_to_y = self.get_map_transforms(
+        src = np.asarray(src)
+        xy_map = self.get_map_transforms(
             width=int(width),
             height=int(height)
         )
-        res = cv2.remap(src, map_to_x, map_to_y, cv2.INTER_CUBIC)
+        res = cv2.remap(src, xy_map, None, cv2.INTER_CUBIC,
+                        borderMode=cv2.BORDER_CONSTANT, borderValue=0)
 
         return Image.fromarray(res)
     
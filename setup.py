@@ -14,7 +14,8 @@ setup(
                 "as its taken by Himawari 8 (ひまわり8号) and sets it as your desktop background.",
     long_description=long_description,
     long_description_content_type="text/markdown",
-    install_requires=["appdirs", "pillow", "python-dateutil", "numpy"],
+    install_requires=["appdirs", "pillow-simd", "python-dateutil", "numpy", "httpx[http2]"],
+    extras_require={"jit": ["numba"]},
     include_package_data=True,
     packages=find_packages(),
     entry_points={"console_scripts": ["himawaripy=himawaripy.__main__:main"]},